@@ -43,18 +43,48 @@ class KeyboardInference(inference.InferenceModule):
         self.beliefs = util.Counter()
         for p in self.legalPositions: self.beliefs[p] = 1.0
         self.beliefs.normalize()
+        self.feasibleDistances = {}
+        self.pacmanCache = inference.PositionCache(self.buildCacheEntry)
+
+    def buildCacheEntry(self, pacmanPosition):
+        """
+        Return a (distance rings, beliefs by noisy distance) pair for
+        pacmanPosition. The rings map each true distance from pacmanPosition
+        to the legal positions at that distance.
+        """
+        rings = {}
+        for p in self.legalPositions:
+            trueDistance = util.manhattanDistance(p, pacmanPosition)
+            rings.setdefault(trueDistance, []).append(p)
+        return (rings, {})
+
+    def isFeasibleDistance(self, noisyDistance, trueDistance):
+        "Return whether noisyDistance can be observed at trueDistance."
+        key = (noisyDistance, trueDistance)
+        if key not in self.feasibleDistances:
+            self.feasibleDistances[key] = \
+                busters.getObservationProbability(noisyDistance, trueDistance) > 0
+        return self.feasibleDistances[key]
 
     def update(self, observation, gameState):
+        """
+        Spread belief uniformly over every position consistent with the noisy
+        distance. Results are memoized per (Pacman position, noisy distance),
+        so the returned Counter is shared and must not be modified in place.
+        """
         noisyDistance = observation
         pacmanPosition = gameState.getPacmanPosition()
-        allPossible = util.Counter()
-        for p in self.legalPositions:
-            trueDistance = util.manhattanDistance(p, pacmanPosition)
-            if noisyDistance != None and \
-                    busters.getObservationProbability(noisyDistance, trueDistance) > 0:
-                allPossible[p] = 1.0
-        allPossible.normalize()
-        self.beliefs = allPossible
+        rings, observationBeliefs = self.pacmanCache[pacmanPosition]
+        if noisyDistance not in observationBeliefs:
+            allPossible = util.Counter()
+            if noisyDistance != None:
+                for trueDistance, positions in rings.items():
+                    if self.isFeasibleDistance(noisyDistance, trueDistance):
+                        for p in positions:
+                            allPossible[p] = 1.0
+            allPossible.normalize()
+            observationBeliefs[noisyDistance] = allPossible
+        self.beliefs = observationBeliefs[noisyDistance]
 
     def predict(self, gameState):
         pass
@@ -62,6 +92,10 @@ class KeyboardInference(inference.InferenceModule):
     def getBeliefDistribution(self):
         return self.beliefs
 
+    def restore(self, checkpoint):
+        self.checkCheckpoint(checkpoint, inference.BeliefCheckpoint.EXACT, self.index)
+        self.beliefs = util.Counter(zip(checkpoint.positions, checkpoint.values))
+
 
 class BustersAgent:
     "An agent that tracks and displays its beliefs about ghost positions."